@@ -1,199 +1,742 @@
-import math
+import html
+import io
+import itertools
 import random
+import re
+import sqlite3
 import time
 import timeit
-from typing import List, Tuple, Optional, Any
-from datetime import timedelta
-import requests
-from bs4 import BeautifulSoup
+from typing import List, Tuple, Optional, Any, Iterable
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import httpx
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+from lxml import etree
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 import threading
 import csv
 import logging
 import argparse
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
 
-# Configure logging to save to a file and print to console
+# Configure logging to save to a file and print to console.
+# Workers only enqueue records, a single listener thread formats and writes them.
+log_queue: queue.Queue = queue.Queue(-1)
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s',
-                    handlers=[
-                        logging.FileHandler('scraping.log', 'a'),
-                        logging.StreamHandler()
-                    ])
-lock = threading.Lock()
-lock_count = threading.Lock()
-lock_error = threading.Lock()
+                    handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, logging.FileHandler('scraping.log', 'a'), logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+# httpx logs every request at INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+thread_local = threading.local()
 
 FILE_NAME = 'new_descriptions.csv'
 ERROR_FILE_NAME = 'scraping_errors.csv'
-MAX_WORKERS = 128
-CHUNKS = 100 * MAX_WORKERS
-
-scraped_count = 0
+REQUEST_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+MAX_REQUEST_DELAY = 60.0
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_ATTEMPTS = 5
+BREAKER_THRESHOLD = 10  # Consecutive failures after which a host is cut off
+BREAKER_COOLDOWN = 30.0  # Seconds before a cut off host is probed again
+
+# Fast path for locating the description without building a DOM
+DESCRIPTION_RE = re.compile(
+    rb'<div[^>]*\bclass="(?:[^"]*\s)?DetailsLayoutRightParagraph(?:\s[^"]*)?"[^>]*>(.*?)</div>', re.DOTALL)
+TAG_RE = re.compile(rb'<[^>]+>')
+DESCRIPTION_CLASS = 'DetailsLayoutRightParagraph'
+DESCRIPTION_MARKER = DESCRIPTION_CLASS.encode()
+READ_CHUNK_SIZE = 16 * 1024
+MAX_PAGE_BYTES = 1024 * 1024  # Stop downloading pages past this size
+
+DB_FILE_NAME = 'descriptions.db'
+SAVE_EVERY = 64  # Rows a worker buffers before inserting them into the database
+IN_FLIGHT_PER_WORKER = 4  # Tasks submitted ahead per worker, bounds how many futures exist at once
+CACHE_FILE_NAME = 'scrape_cache.sqlite'
+CACHE_EXPIRE_AFTER = timedelta(days=7)
+
+scraped_counter = itertools.count(1)  # next() is atomic, so workers need no lock to count
+PROGRESS_EVERY = 100
 start_time = timeit.default_timer()
 total_urls = 0  # This will be set after reading the CSV
 starting_index = 0
+requests_per_second = 20.0  # Per host, before any 429/503 backoff
+
+# Browser user agents to mimic real visitors, rotated in turn across requests
+USER_AGENTS: Tuple[str, ...] = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.5060.53 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Windows; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.5060.114 Safari/537.36',
+)
+headers_list: Tuple[dict[str, str], ...] = tuple({'User-Agent': user_agent} for user_agent in USER_AGENTS)
+headers_cycle = itertools.cycle(headers_list)  # next() is atomic, so workers can share it
+
+
+class ThrottleState:
+    """
+    Politeness state of a single host: when its next request may start and the current delay between requests.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.next_request = 0.0
+        self.min_delay = 1 / requests_per_second
+
+
+host_state: dict[str, ThrottleState] = {}
+host_state_lock = threading.Lock()
+
+
+def get_throttle_state(host: str) -> ThrottleState:
+    """
+    Function to get the throttle state of a host, creating it on first use.
+
+    Args:
+        host (str): Network location of the URL.
+
+    Returns:
+        ThrottleState: State shared by all workers requesting the host.
+    """
+    state = host_state.get(host)
+    if state is None:
+        with host_state_lock:
+            state = host_state.setdefault(host, ThrottleState())
+    return state
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Function to parse a Retry-After header.
+
+    Args:
+        value (Optional[str]): Header value, either a number of seconds or an HTTP date.
+
+    Returns:
+        Optional[float]: Number of seconds to wait, or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def wait_for_host(host: str) -> None:
+    """
+    Function to block until the next request to a host is allowed.
+
+    Each caller reserves its own slot, so concurrent workers hitting the same host are spaced min_delay apart.
+
+    Args:
+        host (str): Network location of the URL.
+    """
+    state = get_throttle_state(host)
+    with state.lock:
+        now = time.monotonic()
+        slot = max(now, state.next_request)
+        state.next_request = slot + state.min_delay
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def update_throttle(host: str, response: httpx.Response) -> None:
+    """
+    Function to adapt the request delay of a host to its latest response.
+
+    The delay grows by half on 429/503 (honoring Retry-After) and slowly decays back to 1 / requests_per_second
+    otherwise.
+
+    Args:
+        host (str): Network location of the URL.
+        response (httpx.Response): Response received from the host.
+    """
+    state = get_throttle_state(host)
+    with state.lock:
+        if response.status_code in THROTTLE_STATUSES:
+            state.min_delay = min(state.min_delay * 1.5, MAX_REQUEST_DELAY)
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                state.next_request = max(state.next_request, time.monotonic() + retry_after)
+            logging.warning(f"Throttled by {host}, delay between requests is now {state.min_delay:.2f}s")
+        else:
+            state.min_delay = max(1 / requests_per_second, state.min_delay * 0.95)
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker.
+
+    A host is closed while it works, opens after BREAKER_THRESHOLD consecutive failures and, once
+    BREAKER_COOLDOWN has passed, is half-open: a single probe request is let through to decide
+    whether it closes again or stays open for another cooldown. Workers wait while the circuit is open
+    instead of failing their URLs.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.condition = threading.Condition()
+        self.fail_count: dict[str, int] = {}
+        self.opened_at: dict[str, float] = {}
+        self.probing: set[str] = set()
+
+    def wait_until_closed(self, host: str) -> None:
+        """
+        Function to block until a request to a host may be sent.
+
+        When the cooldown has passed, the first waiter is let through as the half-open probe and the cooldown
+        restarts, so a probe that never reports back does not keep the host cut off forever. The others keep
+        waiting until the probe closes the circuit.
+
+        Args:
+            host (str): Network location of the URL.
+        """
+        with self.condition:
+            while True:
+                opened_at = self.opened_at.get(host)
+                if opened_at is None:
+                    return
+                now = time.monotonic()
+                if now - opened_at < self.cooldown:
+                    self.condition.wait(opened_at + self.cooldown - now)
+                    continue
+                self.opened_at[host] = now
+                self.probing.add(host)
+                logging.info(f"Circuit for {host} is half-open, probing")
+                return
+
+    def record_success(self, host: str) -> None:
+        """
+        Function to record that a host answered, closing its circuit.
+
+        Args:
+            host (str): Network location of the URL.
+        """
+        with self.condition:
+            self.fail_count.pop(host, None)
+            self.probing.discard(host)
+            if self.opened_at.pop(host, None) is not None:
+                logging.info(f"Circuit for {host} closed")
+                self.condition.notify_all()
+
+    def record_failure(self, host: str) -> None:
+        """
+        Function to record a failed request to a host, opening its circuit past the threshold.
+
+        Args:
+            host (str): Network location of the URL.
+        """
+        with self.condition:
+            fail_count = self.fail_count.get(host, 0) + 1
+            self.fail_count[host] = fail_count
+            if host in self.probing or (host not in self.opened_at and fail_count >= self.threshold):
+                self.probing.discard(host)
+                self.opened_at[host] = time.monotonic()
+                logging.warning(f"Circuit for {host} opened after {fail_count} consecutive failures")
+                self.condition.notify_all()
+
+
+breaker = CircuitBreaker()
+
+
+client: Optional[httpx.Client] = None  # Shared by all workers, created in main
+
+
+def create_client(max_connections: int) -> httpx.Client:
+    """
+    Function to create the HTTP client shared by all worker threads.
+
+    HTTP/2 lets concurrent requests to the same host share one connection, so TLS handshakes and headers
+    are paid far less often, and responses are requested compressed.
+
+    Args:
+        max_connections (int): Maximum number of open (and keep-alive) connections, usually the number of workers.
+
+    Returns:
+        httpx.Client: The client.
+    """
+    # Retries are handled by fetch_page, so they go through the per-host throttle
+    return httpx.Client(http2=True,
+                        limits=httpx.Limits(max_connections=max_connections,
+                                            max_keepalive_connections=max_connections),
+                        headers={'Accept-Encoding': 'gzip, br'},
+                        timeout=REQUEST_TIMEOUT,
+                        follow_redirects=True)
+
+
+def read_page(response: httpx.Response, limit: int = MAX_PAGE_BYTES) -> bytes:
+    """
+    Function to read a streamed book page only as far as the description.
+
+    The body is read in chunks and stops being kept as soon as the description div has been closed
+    (or the size limit is reached). On HTTP/2 the rest of the body is still read and dropped, because
+    closing a stream early never hands its flow-control window back to the shared connection, which
+    stalls every request on it once the window is used up.
+
+    Args:
+        response (httpx.Response): Streamed response.
+        limit (int, optional): Maximum number of bytes to read. Defaults to MAX_PAGE_BYTES.
+
+    Returns:
+        bytes: The (possibly truncated) page.
+    """
+    body = bytearray()
+    marker_at = -1
+    chunks = response.iter_bytes(chunk_size=READ_CHUNK_SIZE)
+    for chunk in chunks:
+        scan_from = max(0, len(body) - len(DESCRIPTION_MARKER))
+        body += chunk
+        if marker_at < 0:
+            marker_at = body.find(DESCRIPTION_MARKER, scan_from)
+        if marker_at >= 0 and body.find(b'</div>', marker_at) >= 0:
+            break
+        if len(body) >= limit:
+            break
+    if response.http_version == 'HTTP/2':
+        for _ in chunks:
+            pass
+    return bytes(body)
+
+
+def fetch_page(client: httpx.Client, url: str) -> bytes:
+    """
+    Function to download a book page, retrying transient failures.
+
+    429/5xx responses, connection errors and timeouts are retried with exponential backoff and jitter
+    (or after Retry-After when the server sends it), up to MAX_ATTEMPTS attempts.
+
+    Args:
+        client (httpx.Client): Shared HTTP client.
+        url (str): URL of the book page.
+
+    Returns:
+        bytes: The (possibly truncated) page.
+
+    Raises:
+        httpx.HTTPError: If the last attempt fails.
+    """
+    host = urlparse(url).netloc
+    attempt = 0
+    while True:
+        attempt += 1
+        last_attempt = attempt == MAX_ATTEMPTS
+        delay = 2 ** (attempt - 1) + random.random()
+        headers = next(headers_cycle)
+        breaker.wait_until_closed(host)
+        wait_for_host(host)
+        try:
+            with client.stream('GET', url, headers=headers) as response:
+                update_throttle(host, response)
+                if response.status_code in RETRY_STATUSES:
+                    breaker.record_failure(host)
+                else:
+                    breaker.record_success(host)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    response.raise_for_status()
+                    return read_page(response)
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None:
+                    delay = retry_after
+                reason = f"HTTP {response.status_code}"
+        except httpx.TransportError as e:
+            breaker.record_failure(host)
+            if last_attempt:
+                raise
+            reason = str(e)
+        logging.warning(f"Attempt {attempt}/{MAX_ATTEMPTS} for {url} failed ({reason}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+
+page_cache: Optional[sqlite3.Connection] = None  # Opened in main
+page_cache_lock = threading.Lock()
+
+
+def open_page_cache(file_path: str = CACHE_FILE_NAME) -> sqlite3.Connection:
+    """
+    Function to open the on-disk cache of fetched pages, so reruns don't download them again.
+
+    Args:
+        file_path (str, optional): Path to the SQLite cache. Defaults to CACHE_FILE_NAME.
+
+    Returns:
+        sqlite3.Connection: Connection shared by all workers, guarded by page_cache_lock.
+    """
+    connection = sqlite3.connect(file_path, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, fetched_at REAL NOT NULL, '
+                       'body BLOB NOT NULL)')
+    return connection
+
+
+def get_cached_page(url: str) -> Optional[bytes]:
+    """
+    Function to look up a page in the cache.
+
+    Args:
+        url (str): URL of the book page.
+
+    Returns:
+        Optional[bytes]: The cached page, or None if it is missing, expired or the cache is disabled.
+    """
+    if page_cache is None:
+        return None
+    with page_cache_lock:
+        row = page_cache.execute('SELECT body FROM pages WHERE url = ? AND fetched_at >= ?',
+                                 (url, time.time() - CACHE_EXPIRE_AFTER.total_seconds())).fetchone()
+    return row[0] if row else None
+
+
+def cache_page(url: str, page: bytes) -> None:
+    """
+    Function to store a fetched page in the cache.
+
+    Caching is best-effort: if the page can't be stored (e.g. the disk is full), the error is logged
+    and the page is still scraped.
+
+    Args:
+        url (str): URL of the book page.
+        page (bytes): The (possibly truncated) page.
+    """
+    if page_cache is None:
+        return
+    try:
+        with page_cache_lock:
+            page_cache.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (url, time.time(), page))
+    except sqlite3.Error as e:
+        logging.warning(f"Error caching page {url}: {e}")
+
 
-# Random headers to mimic a real browser
-headers_list: List[dict[str, str]] = [
-    {
-        'User-Agent':
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'},
-    {
-        'User-Agent':
-            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0.3 Safari/605.1.15'},
-    {
-        'User-Agent':
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'},
-    {
-        'User-Agent':
-            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36'},
-    {
-        'User-Agent':
-            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.5060.53 Safari/537.36'},
-    {
-        'User-Agent':
-            'Mozilla/5.0 (Windows NT 10.0; Windows; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/103.0.5060.114 Safari/537.36'},
-]
-
-
-def scrape_urls(data: List[Tuple[int, str]]) -> str:
-    """
-   Function to scrape URLs for book descriptions.
-
-   Args:
-       data (List[Tuple[int, str]]): List of tuples containing book ID and URL.
-
-   Returns:
-       str: Message indicating completion of scraping.
-   """
-    global scraped_count
-
-    results: List[Tuple[int, Optional[str]]] = []
-    for row in data:
-        book_id, url = row
+def extract_description(page: bytes) -> Optional[str]:
+    """
+    Function to extract the book description from a book page.
+
+    A precompiled regex is tried first. When it misses, the page is streamed through lxml's iterparse,
+    which stops at the end of the first description div instead of building the whole tree.
+
+    Args:
+        page (bytes): UTF-8 HTML of the book page.
+
+    Returns:
+        Optional[str]: Stripped description text, or None if the description div was not found.
+    """
+    match = DESCRIPTION_RE.search(page)
+    if match:
+        return html.unescape(TAG_RE.sub(b'', match.group(1)).decode('utf-8', errors='replace')).strip()
+
+    description_div = None
+    try:
+        for event, div in etree.iterparse(io.BytesIO(page), events=('start', 'end'), tag='div', html=True,
+                                          encoding='utf-8'):
+            if description_div is None:
+                if event == 'start' and DESCRIPTION_CLASS in (div.get('class') or '').split():
+                    description_div = div
+                elif event == 'end':
+                    div.clear()
+            elif div is description_div:
+                return ''.join(div.itertext()).strip()
+    except etree.XMLSyntaxError:
+        pass
+    return None
+
+
+class RowBuffer:
+    """
+    Rows scraped by one worker thread that have not been saved to the database yet, kept as columns.
+    """
+
+    def __init__(self) -> None:
+        self.ids: List[int] = []
+        self.descriptions: List[Optional[str]] = []
+        self.errors: List[Tuple[int, str, str]] = []
+
+
+row_buffers: List[RowBuffer] = []
+
+
+def get_row_buffer() -> RowBuffer:
+    """
+    Function to get the row buffer of the current worker thread, creating it on first use.
+
+    Returns:
+        RowBuffer: Buffer only ever filled by the current thread.
+    """
+    buffer = getattr(thread_local, 'row_buffer', None)
+    if buffer is None:
+        buffer = thread_local.row_buffer = RowBuffer()
+        row_buffers.append(buffer)
+    return buffer
+
+
+def flush_row_buffer(buffer: RowBuffer) -> None:
+    """
+    Function to save the buffered rows and errors to the database and empty the buffer.
+
+    Args:
+        buffer (RowBuffer): Buffer to flush.
+    """
+    if buffer.ids:
+        save_to_db(buffer.ids, buffer.descriptions)
+        buffer.ids.clear()
+        buffer.descriptions.clear()
+    if buffer.errors:
+        log_errors_to_db(buffer.errors)
+        buffer.errors.clear()
+
+
+def scrape_one(url_group: Tuple[List[int], str]) -> None:
+    """
+    Function to scrape a single URL for a book description.
+
+    The description is saved for every book sharing the URL. Results are buffered by the worker thread
+    and saved every SAVE_EVERY rows.
+
+    Args:
+        url_group (Tuple[List[int], str]): IDs of the books sharing the URL, and the URL.
+    """
+    book_ids, url = url_group
+    buffer = get_row_buffer()
+    description = None
+    try:
+        page = get_cached_page(url)
+        if page is None:
+            page = fetch_page(client, url)
+            cache_page(url, page)
+        description = extract_description(page)
+        if description is not None:
+            logging.debug(f"Scraped description for ID's {book_ids} from {url}")
+            # If description is too short, set it to None
+            if len(description) < 10:
+                description = None
+        else:
+            logging.warning(f"No description found for ID's {book_ids} at {url}")
+    except Exception as e:
+        logging.error(f"Error scraping URL {url} for ID's {book_ids}: {e}")
+        buffer.errors.extend((book_id, url, str(e)) for book_id in book_ids)
+    finally:
+        buffer.ids.extend(book_ids)
+        buffer.descriptions.extend(itertools.repeat(description, len(book_ids)))
+        if len(buffer.ids) >= SAVE_EVERY:
+            flush_row_buffer(buffer)
+
+        scraped_count = next(scraped_counter)
+        if scraped_count % PROGRESS_EVERY == 0:
+            elapsed_time = timeit.default_timer() - start_time
+            remaining_urls = total_urls - scraped_count
+            avg_time_per_url = elapsed_time / scraped_count
+            approx_time_left = avg_time_per_url * remaining_urls
+
+            # Convert seconds into a timedelta object, then format as HH:MM:SS
+            approx_time_left_formatted = str(timedelta(seconds=int(approx_time_left)))
+
+            logging.info(
+                f"Scraped {scraped_count}/{total_urls}. Approx. time left: {approx_time_left_formatted} (HH:MM:SS)")
+        if scraped_count == total_urls:
+            logging.info(f"All URLs scraped")
+
+
+db: Optional[sqlite3.Connection] = None  # Opened in main
+db_lock = threading.Lock()
+
+
+def open_db(file_path: str = DB_FILE_NAME) -> sqlite3.Connection:
+    """
+    Function to open the database scraped descriptions and errors are saved to.
+
+    Args:
+        file_path (str, optional): Path to the SQLite database. Defaults to DB_FILE_NAME.
+
+    Returns:
+        sqlite3.Connection: Connection shared by all workers, guarded by db_lock.
+    """
+    connection = sqlite3.connect(file_path, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS descriptions (id INTEGER NOT NULL, description TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS errors (id INTEGER NOT NULL, url TEXT NOT NULL, '
+                       'message TEXT NOT NULL)')
+    # Last row of each table already exported to its CSV file
+    connection.execute('CREATE TABLE IF NOT EXISTS exports (name TEXT PRIMARY KEY, last_rowid INTEGER NOT NULL)')
+    return connection
+
+
+def insert_many(sql: str, rows: Iterable[Iterable[Any]]) -> None:
+    """
+    Function to insert a batch of rows into the database in a single transaction.
+
+    Args:
+        sql (str): INSERT statement with one placeholder per column.
+        rows (Iterable[Iterable[Any]]): Rows to insert.
+    """
+    with db_lock:
+        db.execute('BEGIN')
         try:
-            headers = random.choice(headers_list)
-            time.sleep(random.uniform(1, 10))
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.text, 'html.parser')
-            description_div = soup.find('div', class_='DetailsLayoutRightParagraph')
-            if description_div:
-                description = description_div.text.strip()
-                logging.info(f"Scraped description for ID {book_id} from {url}")
-                # If description is too short, set it to None
-                if len(description) < 10:
-                    description = None
-                results.append((book_id, description))
-            else:
-                logging.warning(f"No description found for ID {book_id} at {url}")
-                results.append((book_id, None))
-        except Exception as e:
-            logging.error(f"Error scraping URL {url} for ID {book_id}: {e}")
-            error_message = str(e)
-            results.append((book_id, None))
-            log_error_to_csv(book_id, url, error_message)
-        finally:
-            with lock_count:
-                scraped_count += 1
-                if scraped_count % 10 == 0:
-                    elapsed_time = timeit.default_timer() - start_time
-                    remaining_urls = total_urls - scraped_count
-                    avg_time_per_url = elapsed_time / scraped_count if scraped_count else float('inf')
-                    approx_time_left = avg_time_per_url * remaining_urls
-
-                    # Convert seconds into a timedelta object, then format as HH:MM:SS
-                    approx_time_left_formatted = str(timedelta(seconds=int(approx_time_left)))
-
-                    logging.info(
-                        f"Scraped {scraped_count}/{total_urls}. Approx. time left: {approx_time_left_formatted} (HH:MM:SS)")
-                if scraped_count == total_urls:
-                    logging.info(f"All URLs scraped")
-    save_to_csv(results)
-    return "Scraping complete"
-
-
-def save_to_csv(data: List[Tuple[int, str]], file_path: str = FILE_NAME) -> None:
-    """
-    Function to save scraped data to a CSV file.
-
-    Args:
-        data (List[Tuple[int, str]]): List of tuples containing book ID and description.
-        file_path (str, optional): Path to the CSV file. Defaults to FILE_NAME.
+            db.executemany(sql, rows)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+def save_to_db(ids: List[int], descriptions: List[Optional[str]]) -> None:
+    """
+    Function to save scraped data to the database.
+
+    Args:
+        ids (List[int]): Book IDs.
+        descriptions (List[Optional[str]]): Descriptions, in the same order as ids.
     """
     try:
-        with lock:
-            with open(file_path, 'a', newline='', encoding='utf-8') as file:
-                writer = csv.writer(file)
-                for row in data:
-                    writer.writerow(row)
-                    logging.info(f"Data for ID {row[0]} saved to CSV")
+        insert_many('INSERT INTO descriptions VALUES (?, ?)', zip(ids, descriptions))
     except Exception as e:
-        ids = [row[0] for row in data]
-        logging.error(f"Error saving data with ID's {ids} to CSV: {e}")
+        logging.error(f"Error saving data with ID's {ids} to the database: {e}")
 
 
-def log_error_to_csv(book_id: int, url: str, error_message: str, file_path: str = ERROR_FILE_NAME) -> None:
+def log_errors_to_db(errors: List[Tuple[int, str, str]]) -> None:
     """
-    Function to log errors to a CSV file during scraping.
+    Function to log errors encountered during scraping to the database.
 
     Args:
-        book_id (int): The ID of the book that encountered an error.
-        url (str): The URL that was being scraped when the error occurred.
-        error_message (str): A description of the error.
-        file_path (str, optional): Path to the error log CSV file. Defaults to ERROR_FILE_NAME.
+        errors (List[Tuple[int, str, str]]): List of tuples containing book ID, URL and error message.
     """
-    with lock_error:
+    try:
+        insert_many('INSERT INTO errors VALUES (?, ?, ?)', errors)
+    except Exception as e:
+        ids = [error[0] for error in errors]
+        logging.error(f"Error logging errors for ID's {ids} to the database: {e}")
+
+
+def export_to_csv(table: str, file_path: str) -> None:
+    """
+    Function to append the rows of a table that were not exported yet to a CSV file.
+
+    Rows saved by an interrupted run are exported as well.
+
+    Args:
+        table (str): Name of the table, either descriptions or errors.
+        file_path (str): Path to the CSV file.
+    """
+    with db_lock:
+        row = db.execute('SELECT last_rowid FROM exports WHERE name = ?', (table,)).fetchone()
+        last_rowid = row[0] if row else 0
+        rows = db.execute(f'SELECT rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid', (last_rowid,))
         with open(file_path, 'a', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
-            writer.writerow([book_id, url, error_message])
-            logging.info(f"Logged error for ID {book_id} to {file_path}")
+            exported = 0
+            for rowid, *values in rows:
+                writer.writerow(values)
+                last_rowid = rowid
+                exported += 1
+        db.execute('INSERT OR REPLACE INTO exports VALUES (?, ?)', (table, last_rowid))
+    logging.info(f"Exported {exported} rows from {table} to {file_path}")
 
 
-def chunk_data(data: List[Any], n: int) -> List[List[Any]]:
+def skip_invalid_row(row: pa_csv.InvalidRow) -> str:
     """
-    Function to split data into n chunks.
+    Function called by the CSV reader for rows with the wrong number of columns.
 
     Args:
-        data (List[Any]): List of data to be split.
-        n (int): Number of chunks.
+        row (pa_csv.InvalidRow): The invalid row.
 
     Returns:
-        List[List[Any]]: List of chunks.
+        str: 'skip', so the row is dropped and reading continues.
     """
-    k, m = divmod(len(data), n)
-    return [data[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
+    logging.error(f"Error reading row {row.text}: Row must have exactly three columns")
+    return 'skip'
 
 
-def read_id_url_pairs_from_csv(file_path: str = 'bad_descriptions.csv') -> List[List[Tuple[int, str]]]:
+def read_id_url_pairs_from_csv(file_path: str = 'bad_descriptions.csv') -> List[Tuple[int, str]]:
     """
     Function to read book ID and URL pairs from a CSV file.
 
+    The file is parsed by pyarrow and rows with a non-integer ID are filtered out column-wise.
+
     Args:
         file_path (str, optional): Path to the CSV file. Defaults to 'bad_descriptions.csv'.
 
     Returns:
-        List[List[Tuple[int, str]]]: List of book ID and URL pairs.
+        List[Tuple[int, str]]: List of book ID and URL pairs.
     """
-    global total_urls
-    global starting_index
-
-    id_url_pairs = []
-    with open(file_path, 'r', newline='', encoding='utf-8') as file:
-        reader = csv.reader(file)
-        for row in reader:
-            try:
-                id_url_pairs.append((int(row[1]), row[2]))
-            except ValueError:
-                logging.error(f"Error reading row {row}: ID must be an integer")
-            except IndexError:
-                logging.error(f"Error reading row {row}: Row must have at least two columns")
-    id_url_pairs = id_url_pairs[starting_index:]
+    column_names = ['index', 'id', 'url']
+    table = pa_csv.read_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(column_names=column_names),
+        parse_options=pa_csv.ParseOptions(invalid_row_handler=skip_invalid_row),
+        convert_options=pa_csv.ConvertOptions(column_types={name: pa.string() for name in column_names}))
+
+    ids = pc.utf8_trim_whitespace(table['id'])
+    valid = pc.match_substring_regex(ids, r'^-?\d+$')
+    for row in table.filter(pc.invert(valid)).to_pylist():
+        logging.error(f"Error reading row {list(row.values())}: ID must be an integer")
+    ids = pc.cast(ids.filter(valid), pa.int64()).slice(starting_index)
+    urls = table['url'].filter(valid).slice(starting_index)
+
+    id_url_pairs = list(zip(ids.to_pylist(), urls.to_pylist()))
     logging.info(f"Read {len(id_url_pairs)} ID-URL pairs from CSV")
-    total_urls = len(id_url_pairs)
 
-    return chunk_data(id_url_pairs, int(math.sqrt(len(id_url_pairs) * MAX_WORKERS) * 2))
+    return id_url_pairs
+
+
+def group_ids_by_url(id_url_pairs: List[Tuple[int, str]]) -> List[Tuple[List[int], str]]:
+    """
+    Function to group book IDs sharing the same URL, so every URL is scraped only once.
+
+    Args:
+        id_url_pairs (List[Tuple[int, str]]): List of book ID and URL pairs.
+
+    Returns:
+        List[Tuple[List[int], str]]: IDs of the books sharing each unique URL, and the URL, in input order.
+    """
+    global total_urls
+
+    ids_by_url: defaultdict[str, List[int]] = defaultdict(list)
+    for book_id, url in id_url_pairs:
+        ids_by_url[url].append(book_id)
+    total_urls = len(ids_by_url)
+    logging.info(f"Found {total_urls} unique URLs for {len(id_url_pairs)} books")
+
+    return [(book_ids, url) for url, book_ids in ids_by_url.items()]
+
+
+def positive_float(value: str) -> float:
+    """
+    Function to parse a command line argument that must be a number greater than zero.
+
+    Args:
+        value (str): Value given on the command line.
+
+    Returns:
+        float: The parsed value.
+
+    Raises:
+        argparse.ArgumentTypeError: If the value is not a number greater than zero.
+    """
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a number")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"{value!r} must be greater than zero")
+    return number
 
 
 def get_args():
@@ -202,6 +745,8 @@ def get_args():
     parser.add_argument('--max_workers', type=int, default=16,
                         help='Number of workers for ThreadPoolExecutor. Defaults to 16.')
     parser.add_argument('--starting_index', type=int, default=0)
+    parser.add_argument('--requests_per_second', type=positive_float, default=20.0,
+                        help='Maximum requests per second to a single host. Defaults to 20.')
     return parser.parse_args()
 
 
@@ -213,19 +758,39 @@ def main(file_path: str, max_workers: int = 16) -> None:
         file_path (str): Path to the CSV file containing book ID and URL pairs.
         max_workers (int, optional): Number of workers for ThreadPoolExecutor. Defaults to 16.
     """
-    id_url_pairs = read_id_url_pairs_from_csv(file_path)
+    global client
+    global page_cache
+    global db
+
+    url_groups = group_ids_by_url(read_id_url_pairs_from_csv(file_path))
 
+    # Size the connection pool to the number of threads actually running
+    client = create_client(max_workers)
+    page_cache = open_page_cache()
+    db = open_db()
     try:
-        with lock:
-            with open(FILE_NAME, 'a', newline='', encoding='utf-8') as file:
-                if file.tell() == 0:  # Check if file is empty to write headers
-                    csv.writer(file).writerow(['ID', 'Description'])
+        with open(FILE_NAME, 'a', newline='', encoding='utf-8') as file:
+            if file.tell() == 0:  # Check if file is empty to write headers
+                csv.writer(file).writerow(['ID', 'Description'])
 
+        in_flight = threading.BoundedSemaphore(max_workers * IN_FLIGHT_PER_WORKER)
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            executor.map(scrape_urls, id_url_pairs)
             logging.info("Scraping initiated")
+            # Workers take URLs one at a time from the executor's queue, so a slow URL only holds up itself.
+            # Submitting blocks while enough tasks are pending, instead of creating a future for every URL up front.
+            for url_group in url_groups:
+                in_flight.acquire()
+                executor.submit(scrape_one, url_group).add_done_callback(lambda _: in_flight.release())
     except Exception as e:
         logging.error(f"Error in main function: {e}")
+    finally:
+        for buffer in row_buffers:
+            flush_row_buffer(buffer)
+        export_to_csv('descriptions', FILE_NAME)
+        export_to_csv('errors', ERROR_FILE_NAME)
+        client.close()
+        page_cache.close()
+        db.close()
 
 
 if __name__ == "__main__":
@@ -233,6 +798,7 @@ if __name__ == "__main__":
     file_path = args.file_path if args.file_path else 'bad_descriptions_138.csv'
     max_workers = args.max_workers
     starting_index = args.starting_index
+    requests_per_second = args.requests_per_second
 
     logging.info("Starting scraping")
     start = timeit.default_timer()